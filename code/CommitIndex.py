@@ -0,0 +1,168 @@
+import csv
+import os
+import sqlite3
+
+
+class CommitIndex:
+    """Global index of commit hashes already extracted, shared by every repo of a crawl.
+
+    Forks, mirrors and vendored copies share most of their history. The index remembers
+    every commit that was reachable in an already processed repo, so the extractor only
+    has to walk (and emit) the part of the history it has not seen before. Which repos
+    contain which commit is kept as a membership link in the same database.
+
+    The index only makes sense together with the commits CSV it deduplicates against, so it
+    also records that output, its size after the last processed repo and the processed repos.
+    """
+
+    BATCH_SIZE = 500
+
+    def __init__(self, db_path="data/commit_index.sqlite", expected_commits=10_000_000, bits_per_commit=10):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS commit_repos ("
+            "commit_hash TEXT NOT NULL, "
+            "repo_full_name TEXT NOT NULL, "
+            "PRIMARY KEY (commit_hash, repo_full_name)"
+            ") WITHOUT ROWID"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS processed_repos (repo_full_name TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS output (csv_path TEXT NOT NULL, csv_size INTEGER NOT NULL)")
+        self.connection.commit()
+
+        # Bloom filter in front of the database, so most unseen commits never hit the disk
+        self.bloom_bits = max(8, expected_commits * bits_per_commit)
+        self.bloom_hashes = 7
+        self.bloom = bytearray((self.bloom_bits + 7) // 8)
+        self.load_bloom_filter()
+
+    def _bloom_positions(self, commit_hash):
+        # commit hashes are SHA-1 digests, so their bits are already uniformly distributed
+        h1 = int(commit_hash[:16], 16)
+        h2 = int(commit_hash[16:32], 16) | 1
+        return [(h1 + i * h2) % self.bloom_bits for i in range(self.bloom_hashes)]
+
+    def _bloom_add(self, commit_hash):
+        for position in self._bloom_positions(commit_hash):
+            self.bloom[position >> 3] |= 1 << (position & 7)
+
+    def _bloom_might_contain(self, commit_hash):
+        return all(self.bloom[position >> 3] & (1 << (position & 7))
+                   for position in self._bloom_positions(commit_hash))
+
+    def load_bloom_filter(self):
+        """Rebuild the Bloom filter from the commits stored on disk."""
+        print(f"Loading commit index from {self.db_path}...")
+        count = 0
+        for (commit_hash,) in self.connection.execute("SELECT DISTINCT commit_hash FROM commit_repos"):
+            self._bloom_add(commit_hash)
+            count += 1
+        print(f"Commit index contains {count} commits.")
+
+    def bind_output(self, csv_path):
+        """Check that csv_path is the commits CSV this index was built with.
+
+        Raises ValueError when the index belongs to another output, or when its output is missing
+        or shorter than recorded: the commits in the index would never be extracted again. Rows
+        appended after the last processed repo, by a run that crashed before recording the repo,
+        are truncated so the repo can be processed again without duplicating them.
+        """
+        csv_size = os.path.getsize(csv_path) if os.path.exists(csv_path) else 0
+        row = self.connection.execute("SELECT csv_path, csv_size FROM output").fetchone()
+        if row is None:
+            has_commits = self.connection.execute("SELECT 1 FROM commit_repos LIMIT 1").fetchone() is not None
+            if has_commits or csv_size > 0:
+                raise ValueError(f"Commit index {self.db_path} and {csv_path} were not created together. "
+                                 f"Start a new crawl with a new commit index and output.")
+            self.set_output(csv_path)
+            return
+
+        recorded_path, recorded_size = row
+        if recorded_path != csv_path:
+            raise ValueError(f"Commit index {self.db_path} belongs to {recorded_path}, not {csv_path}. "
+                             f"Use a new commit index for a new output.")
+        if csv_size < recorded_size:
+            raise ValueError(f"{csv_path} is missing or shorter than recorded in the commit index {self.db_path}, "
+                             f"the commits of the index would never be extracted again. "
+                             f"Restore it, or delete the commit index as well to recrawl.")
+        if csv_size > recorded_size:
+            print(f"Removing {csv_size - recorded_size} bytes of rows of an unfinished repo from {csv_path}")
+            with open(csv_path, "r+b") as f:
+                f.truncate(recorded_size)
+
+    def set_output(self, csv_path):
+        """Record csv_path, with its current size, as the output of this index."""
+        csv_size = os.path.getsize(csv_path) if os.path.exists(csv_path) else 0
+        self.connection.execute("DELETE FROM output")
+        self.connection.execute("INSERT INTO output (csv_path, csv_size) VALUES (?, ?)", (csv_path, csv_size))
+        self.connection.commit()
+
+    def get_processed_repos(self):
+        return {repo_full_name for (repo_full_name,) in self.connection.execute(
+            "SELECT repo_full_name FROM processed_repos")}
+
+    def get_seen_commits(self, commit_hashes):
+        """Return the subset of commit_hashes that is already in the index."""
+        candidates = [commit_hash for commit_hash in commit_hashes if self._bloom_might_contain(commit_hash)]
+        seen = set()
+        for start in range(0, len(candidates), self.BATCH_SIZE):
+            batch = candidates[start:start + self.BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.connection.execute(
+                f"SELECT DISTINCT commit_hash FROM commit_repos WHERE commit_hash IN ({placeholders})", batch)
+            seen.update(commit_hash for (commit_hash,) in rows)
+        return seen
+
+    def add_repo_commits(self, repo_full_name, commit_hashes):
+        """Link all commits reachable in a repo to it. They are stored by mark_repo_processed."""
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO commit_repos (commit_hash, repo_full_name) VALUES (?, ?)",
+            ((commit_hash, repo_full_name) for commit_hash in commit_hashes))
+        for commit_hash in commit_hashes:
+            self._bloom_add(commit_hash)
+
+    def mark_repo_processed(self, repo_full_name, csv_path):
+        """Store the links of a repo, the repo and the output size in one transaction, after its rows are saved."""
+        csv_size = os.path.getsize(csv_path) if os.path.exists(csv_path) else 0
+        self.connection.execute("INSERT OR IGNORE INTO processed_repos (repo_full_name) VALUES (?)", (repo_full_name,))
+        self.connection.execute("UPDATE output SET csv_size = ?", (csv_size,))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def merge_from(self, db_path):
+        """Add all commit to repo links of another index, e.g. the one of a crawl shard."""
+        self.connection.commit()
+        self.connection.execute("ATTACH DATABASE ? AS other", (db_path,))
+        self.connection.execute(
+            "INSERT OR IGNORE INTO commit_repos SELECT commit_hash, repo_full_name FROM other.commit_repos")
+        self.connection.execute(
+            "INSERT OR IGNORE INTO processed_repos SELECT repo_full_name FROM other.processed_repos")
+        self.connection.commit()
+        # only the attached commits are new to the Bloom filter
+        for (commit_hash,) in self.connection.execute("SELECT DISTINCT commit_hash FROM other.commit_repos"):
+            self._bloom_add(commit_hash)
+        self.connection.execute("DETACH DATABASE other")
+
+    def save_repo_commits_to_csv(self, csv_path="data/commit_repos.csv"):
+        """Export the commit to repo membership links to a CSV file, streamed so the index never has to fit in memory."""
+        directory = os.path.dirname(csv_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        count = 0
+        with open(csv_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["commit_hash", "repo_full_name"])
+            for row in self.connection.execute("SELECT commit_hash, repo_full_name FROM commit_repos"):
+                writer.writerow(row)
+                count += 1
+        print(f"Saved {count} commit to repo links to {csv_path}.")
+        return count
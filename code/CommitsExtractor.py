@@ -4,17 +4,30 @@ import pandas as pd
 import shutil
 import stat
 
+from CommitIndex import CommitIndex
 from Repo import Repo
+from Sharding import Sharding
 
 
 class CommitsExtractor:
 
     @staticmethod
-    def get_commits_for_repo(repo_obj, clone_path):
+    def get_commits_for_repo(repo_obj, clone_path, commit_index=None):
         print(f"Cloning {repo_obj.clone_url} into {clone_path}")
         CommitsExtractor.clone_repo(repo_obj.clone_url, clone_path)
+        if not CommitsExtractor.has_commits(clone_path):
+            print(f"{repo_obj.full_name} has no commits.")
+            return []
         print(f"Extracting commit data from {clone_path}")
-        commit_data = CommitsExtractor.extract_commit_data(clone_path)
+        excluded_commits = set()
+        if commit_index is not None:
+            # Commits already extracted from another copy of this history (fork, mirror, ...)
+            # are only linked to this repo, their ancestry is not walked again
+            reachable_commits = CommitsExtractor.list_reachable_commits(clone_path)
+            excluded_commits = commit_index.get_seen_commits(reachable_commits)
+            print(f"{len(excluded_commits)} of {len(reachable_commits)} commits already in the commit index.")
+            commit_index.add_repo_commits(repo_obj.full_name, reachable_commits)
+        commit_data = CommitsExtractor.extract_commit_data(clone_path, excluded_commits)
         rows = CommitsExtractor.format_commits(repo_obj, commit_data)
         return rows
 
@@ -31,15 +44,50 @@ class CommitsExtractor:
         except FileNotFoundError:
             return None
     @staticmethod
-    def get_commits_for_all_repos_in_csv(repos_csv_file_path="data/all_repos_has_pipeline_check.csv"):
+    def get_commits_for_all_repos_in_csv(repos_csv_file_path="data/all_repos_has_pipeline_check.csv",
+                                         commit_index_path="data/commit_index.sqlite",
+                                         commits_csv_path="data/repo_commits.csv",
+                                         commit_repos_csv_path="data/commit_repos.csv",
+                                         clone_path="C:/Users/Luka/Development/2024/IRD2/cloned_repo",
+                                         shard=None):
         # get commits for all repos with pipelines
         repos = Repo.create_repo_objects_from_csv(repos_csv_file_path)
         # filter repos so only the ones that have pipelines are processed for commits
         repos = [repo for repo in repos if repo.has_pipeline]
+        if shard is not None:
+            # every shard gets its own output, checkpoint, commit index and clone directory
+            repos = [repo for repo in repos if Sharding.in_shard(repo.full_name, shard)]
+            commits_csv_path = Sharding.shard_path(commits_csv_path, shard)
+            if commit_index_path is not None:
+                commit_index_path = Sharding.shard_path(commit_index_path, shard)
+                commit_repos_csv_path = Sharding.shard_path(commit_repos_csv_path, shard)
+            clone_path = f"{clone_path}_shard-{shard[0]}-of-{shard[1]}"
+            print(f"Shard {shard[0]}/{shard[1]}: writing to {commits_csv_path}")
         print(f"Processing {len(repos)} repositories with pipelines...")
         repo_commits = []
-        last_processed_repo = CommitsExtractor.get_last_processed_repo()
-        print("last_processed_repo: ", last_processed_repo)
+        last_processed_repo = None
+        commit_index = None
+        if commit_index_path is not None:
+            commit_index = CommitIndex(commit_index_path)
+            # Fail instead of silently skipping commits the index has seen for another output
+            commit_index.bind_output(commits_csv_path)
+        checkpoint_path = Sharding.checkpoint_path(commits_csv_path)
+        failed_path = Sharding.failed_path(commits_csv_path)
+        if shard is not None:
+            # The merge checks a shard for completeness with its checkpoint. A repo recorded in the index but not
+            # in the checkpoint is processed again, without new rows as all of its commits are in the index.
+            processed_repos = Sharding.load_checkpoint(checkpoint_path)
+        elif commit_index is not None:
+            # Resume from the repos recorded in the index, forks whose commits were all seen before have no rows
+            processed_repos = commit_index.get_processed_repos()
+        else:
+            processed_repos = set()
+            last_processed_repo = CommitsExtractor.get_last_processed_repo(commits_csv_path)
+            print("last_processed_repo: ", last_processed_repo)
+        # repos that failed permanently are not retried
+        processed_repos |= set(Sharding.load_failures(failed_path))
+        print(f"Already processed {len(processed_repos)} repositories.")
+        repos = [repo for repo in repos if repo.full_name not in processed_repos]
 
         # Assume we have not found the start if there is a last_processed_repo
         found_start = last_processed_repo is None
@@ -53,15 +101,78 @@ class CommitsExtractor:
 
             # From this point on, found_start is True, so we process current and subsequent repos
             print(f"Processing {repo.full_name}")
-            commits = CommitsExtractor.get_commits_for_repo(repo, "C:/Users/Luka/Development/2024/IRD2/cloned_repo")
+            try:
+                commits = CommitsExtractor.get_commits_for_repo(repo, clone_path, commit_index)
+            except subprocess.CalledProcessError as e:
+                if not CommitsExtractor.is_permanent_clone_failure(e):
+                    raise  # e.g. a network error, a rerun retries the repo
+                print(f"Skipping {repo.full_name}, it can't be cloned: {e.stderr}")
+                Sharding.mark_failed(failed_path, repo.full_name, e.stderr)
+                continue
             repo_commits.extend(commits)
-            CommitsExtractor.save_commits_to_csv(commits, "data/repo_commits.csv")
+            CommitsExtractor.save_commits_to_csv(commits, commits_csv_path)
+            # Only mark the commits as seen once their rows are safely on disk. After a crash before this,
+            # bind_output truncates the rows of the repo and it is processed again.
+            if commit_index is not None:
+                commit_index.mark_repo_processed(repo.full_name, commits_csv_path)
+            if shard is not None:
+                Sharding.mark_done(checkpoint_path, repo.full_name)
+        if commit_index is not None:
+            # repo_commits.csv lists shared commits only once, the links keep which repos contain them
+            commit_index.save_repo_commits_to_csv(commit_repos_csv_path)
+            commit_index.close()
+
+    @staticmethod
+    def merge_commit_shards(shard_count, repos_csv_file_path="data/all_repos_has_pipeline_check.csv",
+                            commits_csv_path="data/repo_commits.csv",
+                            commit_index_path="data/commit_index.sqlite",
+                            commit_repos_csv_path="data/commit_repos.csv"):
+        """Check that all shards are complete and merge their commits and commit indexes."""
+        if commit_index_path is not None and os.path.exists(commit_index_path):
+            # it may hold commits and repos of an unsharded run that are not in the merged output
+            raise ValueError(f"Cannot merge into {commit_index_path}, it already exists. Move it away first.")
+        repos = Repo.create_repo_objects_from_csv(repos_csv_file_path)
+        expected_repos = [repo.full_name for repo in repos if repo.has_pipeline]
+        if commit_index_path is not None:
+            # forks in different shards both emit their shared commits, keep them once, the links keep the repos
+            dedup_columns = ['commit_hash']
+        else:
+            # without a commit index the rows are the only record of which repo contains which commit
+            dedup_columns = ['repo_full_name', 'commit_hash']
+        merged_rows = Sharding.merge_shards(commits_csv_path, shard_count, expected_repos,
+                                            dedup_columns=dedup_columns, repo_column='repo_full_name')
+        if commit_index_path is not None:
+            temp_index_path = commit_index_path + ".tmp"
+            if os.path.exists(temp_index_path):
+                os.remove(temp_index_path)
+            try:
+                commit_index = CommitIndex(temp_index_path)
+                for index in range(shard_count):
+                    shard_index_path = Sharding.shard_path(commit_index_path, (index, shard_count))
+                    if os.path.exists(shard_index_path):
+                        commit_index.merge_from(shard_index_path)
+                # the merged index can be used to continue the crawl with the merged output
+                commit_index.set_output(commits_csv_path)
+                commit_index.save_repo_commits_to_csv(commit_repos_csv_path)
+                commit_index.close()
+                os.replace(temp_index_path, commit_index_path)
+            finally:
+                if os.path.exists(temp_index_path):
+                    os.remove(temp_index_path)
+        return merged_rows
+
     @staticmethod
     def save_commits_to_csv(commits, csv_path="data/repo_commits.csv"):
         """Save a list of commit dictionaries to a CSV file."""
+        if not commits:
+            # an empty frame would create the file without a header
+            return
         df_commits = pd.DataFrame(commits)
-        # Check if the file exists to decide on writing headers
+        # Check if the file exists to decide on writing headers, a file left with only blank lines needs one too
         header = not pd.io.common.file_exists(csv_path)
+        if not header:
+            with open(csv_path, encoding='utf-8') as f:
+                header = not f.read(1024).strip()
         df_commits.to_csv(csv_path, mode='a', header=header, index=False)
 
     #@staticmethod
@@ -99,20 +210,52 @@ class CommitsExtractor:
     def clone_repo(git_url, clone_path):
         CommitsExtractor.prepare_clone_path(clone_path)
         print(f"Cloning repository from {git_url}...")
-        subprocess.run(["git", "clone", "--no-checkout", git_url, clone_path], check=True)
+        # Fail instead of prompting for credentials, which GitHub asks for when a repo is deleted or private
+        env = {**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+        subprocess.run(["git", "clone", "--no-checkout", git_url, clone_path], check=True, env=env,
+                       stderr=subprocess.PIPE, text=True)
         print("Repository cloned.")
 
     @staticmethod
-    def extract_commit_data(repo_path):
-        print("Starting commit parsing...")
-        cmd = ["git", "-C", repo_path, "log", "--pretty=format:%H %ai %s", "--numstat"]
+    def is_permanent_clone_failure(error):
+        """Deleted, private or disabled repos, cloning them again will fail again."""
+        stderr = (error.stderr or "").lower()
+        return "clone" in error.cmd and any(reason in stderr for reason in
+                                            ["not found", "could not read username", "has been disabled",
+                                             "does not exist", "does not appear to be a git repository"])
+
+    @staticmethod
+    def has_commits(repo_path):
+        cmd = ["git", "-C", repo_path, "rev-parse", "--verify", "--quiet", "HEAD"]
+        return subprocess.run(cmd, capture_output=True).returncode == 0
+
+    @staticmethod
+    def list_reachable_commits(repo_path):
+        cmd = ["git", "-C", repo_path, "rev-list", "HEAD"]
         result = subprocess.run(cmd, capture_output=True, text=True, check=True, encoding='utf-8')
+        return result.stdout.split()
+
+    @staticmethod
+    def extract_commit_data(repo_path, excluded_commits=()):
+        print("Starting commit parsing...")
+        # Revisions are passed on stdin, the list of excluded commits can be far too long for the command line.
+        # Excluding a commit also stops the walk at its whole ancestry.
+        cmd = ["git", "-C", repo_path, "log", "--pretty=format:%H %ai %s", "--numstat", "--stdin"]
+        revisions = "HEAD\n" + "".join(f"^{commit_hash}\n" for commit_hash in excluded_commits)
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, encoding='utf-8')
+        # git reads all revisions from stdin before it starts walking the history
+        try:
+            process.stdin.write(revisions)
+            process.stdin.close()
+        except BrokenPipeError:
+            # git exited without reading them, e.g. repo_path is not a repository, its exit code is checked below
+            pass
         print("Commit data extraction in progress...")
-        print(result.stdout)
         commit_data = []
         current_commit = None  # Start with no current commit
 
-        for line in result.stdout.splitlines():
+        for line in process.stdout:
+            line = line.rstrip("\n")
             if line.strip():
                 parts = line.split(maxsplit=3)
                 # Check if this line starts with a commit hash
@@ -140,6 +283,9 @@ class CommitsExtractor:
         # Add the last commit if it exists
         if current_commit:
             commit_data.append(current_commit)
+        process.stdout.close()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
         print("Commit data extraction completed.")
         return commit_data
 
@@ -0,0 +1,143 @@
+"""Command line entry point for running the crawl stages on one node or shard.
+
+Run from the repository root, e.g. on node 3 of a 16 node batch job:
+
+    python code/Crawl.py commits --shard 3/16
+    python code/Crawl.py merge commits --shards 16
+
+or locally, with several processes standing in for the nodes:
+
+    python code/Crawl.py local commits --shards 4
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+from Sharding import Sharding
+
+STAGES = ["pipelines", "commits", "runs"]
+
+
+def run_stage(args):
+    shard = args.shard
+    if args.stage == "pipelines":
+        from GitHubApi import GitHubApi
+        GitHubApi().check_repos_for_github_actions(args.input, args.output, shard=shard)
+    elif args.stage == "commits":
+        from CommitsExtractor import CommitsExtractor
+        CommitsExtractor.get_commits_for_all_repos_in_csv(args.input, args.commit_index, args.output,
+                                                          commit_repos_csv_path=args.commit_repos,
+                                                          clone_path=args.clone_path, shard=shard)
+    elif args.stage == "runs":
+        from GitHubApi import GitHubApi
+        GitHubApi().fetch_workflow_runs_for_all_repos(args.input, args.output, shard=shard)
+
+
+def merge_stage(args):
+    try:
+        if args.stage == "pipelines":
+            from GitHubApi import GitHubApi
+            GitHubApi.merge_pipeline_check_shards(args.shards, args.input, args.output)
+        elif args.stage == "commits":
+            from CommitsExtractor import CommitsExtractor
+            CommitsExtractor.merge_commit_shards(args.shards, args.input, args.output, args.commit_index,
+                                                 args.commit_repos)
+        elif args.stage == "runs":
+            from GitHubApi import GitHubApi
+            GitHubApi.merge_workflow_run_shards(args.shards, args.input, args.output)
+    except ValueError as e:
+        # incomplete shards or an existing output, nothing was written
+        print(e)
+        return 1
+    return 0
+
+
+def run_local(args):
+    """Run every shard of a stage as a separate process, then merge the results."""
+    stage_args = ["--input", args.input, "--output", args.output]
+    if args.stage == "commits":
+        stage_args += ["--commit-index", args.commit_index, "--commit-repos", args.commit_repos,
+                       "--clone-path", args.clone_path]
+    processes = [
+        subprocess.Popen([sys.executable, __file__, args.stage, "--shard", f"{index}/{args.shards}", *stage_args])
+        for index in range(args.shards)
+    ]
+    failed = [index for index, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        print(f"Shards {failed} failed, rerun them to resume from their checkpoints before merging.")
+        return 1
+    return merge_stage(args)
+
+
+def add_stage_paths(parser, stage):
+    defaults = {
+        "pipelines": ("data/all_repos.csv", "data/all_repos_has_pipeline_check_old.csv"),
+        "commits": ("data/all_repos_has_pipeline_check.csv", "data/repo_commits.csv"),
+        "runs": ("data/all_repos_has_pipeline_check.csv", "data/workflow_runs.csv"),
+    }
+    parser.add_argument("--input", default=defaults[stage][0], help="repo CSV to process")
+    parser.add_argument("--output", default=defaults[stage][1], help="output CSV, suffixed per shard")
+    if stage == "commits":
+        parser.add_argument("--commit-index", default=None,
+                            help="commit index database, defaults to commit_index.sqlite next to the output")
+        parser.add_argument("--commit-repos", default=None,
+                            help="commit to repo links CSV, defaults to commit_repos.csv next to the output")
+        parser.add_argument("--clone-path", default="C:/Users/Luka/Development/2024/IRD2/cloned_repo")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Run the pipeline evolution crawl, optionally sharded.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    for stage in STAGES:
+        stage_parser = commands.add_parser(stage, help=f"run the {stage} stage")
+        stage_parser.add_argument("--shard", type=shard_type, default=None, metavar="i/N",
+                                  help="only process the repos of shard i out of N")
+        add_stage_paths(stage_parser, stage)
+        stage_parser.set_defaults(handler=run_stage, stage=stage)
+
+    for command, handler, help_text in [
+        ("merge", merge_stage, "validate and merge the outputs of all shards of a stage"),
+        ("local", run_local, "run all shards of a stage as local processes and merge them"),
+    ]:
+        command_parser = commands.add_parser(command, help=help_text)
+        stage_commands = command_parser.add_subparsers(dest="stage", required=True)
+        for stage in STAGES:
+            stage_parser = stage_commands.add_parser(stage)
+            stage_parser.add_argument("--shards", type=shard_count_type, required=True, help="number of shards N")
+            add_stage_paths(stage_parser, stage)
+            stage_parser.set_defaults(handler=handler)
+
+    args = parser.parse_args(argv)
+    if args.stage == "commits":
+        # keep the index and the links with the commits they belong to
+        output_directory = os.path.dirname(args.output)
+        if args.commit_index is None:
+            args.commit_index = os.path.join(output_directory, "commit_index.sqlite")
+        if args.commit_repos is None:
+            args.commit_repos = os.path.join(output_directory, "commit_repos.csv")
+    return args
+
+
+def shard_type(value):
+    try:
+        return Sharding.parse_shard(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def shard_count_type(value):
+    count = int(value)
+    if count < 1:
+        raise argparse.ArgumentTypeError("the number of shards must be at least 1")
+    return count
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    return args.handler(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
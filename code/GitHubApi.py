@@ -3,6 +3,7 @@ from datetime import datetime, timedelta
 import pandas as pd
 import requests
 import Repo
+from Sharding import Sharding
 from dotenv import load_dotenv
 import os
 import yaml
@@ -97,7 +98,10 @@ class GitHubApi:
         return df_existing
 
     def check_repos_for_github_actions(self, repo_list_csv_path="data/all_repos.csv",
-                                       new_csv_path="data/all_repos_has_pipeline_check_old.csv"):
+                                       new_csv_path="data/all_repos_has_pipeline_check_old.csv", shard=None):
+        # with a shard, the per-shard output also serves as its checkpoint
+        new_csv_path = Sharding.shard_path(new_csv_path, shard)
+        failed_path = Sharding.failed_path(new_csv_path)
         try:
             # Attempt to load the progress file
             df_progress = pd.read_csv(new_csv_path)
@@ -106,7 +110,12 @@ class GitHubApi:
             df_progress = pd.DataFrame(columns=['owner', 'name', 'full_name', 'has_pipeline'])
             processed_repos = set()
 
+        # repos that failed permanently are not retried
+        processed_repos |= set(Sharding.load_failures(failed_path))
+
         df_repos = pd.read_csv(repo_list_csv_path)
+        if shard is not None:
+            df_repos = df_repos[df_repos['full_name'].apply(lambda full_name: Sharding.in_shard(full_name, shard))]
 
         # Only process repos that haven't been checked yet
         for index, repo in df_repos.iterrows():
@@ -121,6 +130,15 @@ class GitHubApi:
 
             has_pipeline = False
             response = requests.get(workflows_url, headers=self.headers)
+            if GitHubApi.is_permanent_failure(response):
+                print(f"Skipping {full_name}, it can't be accessed: {response.status_code}")
+                Sharding.mark_failed(failed_path, full_name, f"HTTP {response.status_code}")
+                continue
+            if response.status_code not in [200, 404]:
+                # Stop on other errors, e.g. rate limits, without storing the repo as checked, so a rerun retries it
+                print(f"Failed to fetch data for {repo_name}: {response.status_code}")
+                raise requests.HTTPError(f"Failed to fetch workflows of {full_name}: {response.status_code}",
+                                         response=response)
             yaml_files_content = ""  # will contain the content all yaml files
             workflows = []
             number_of_workflows = 0
@@ -144,12 +162,28 @@ class GitHubApi:
             # Save progress incrementally
             df_progress.to_csv(new_csv_path, index=False)
 
-            if response.status_code not in [200, 404]:
-                print(f"Failed to fetch data for {repo_name}: {response.status_code}")
-                break  # Stop if there's an error other than not found
-
         return df_progress
 
+    @staticmethod
+    def is_rate_limited(response):
+        # secondary rate limits don't always set the headers, but say so in the message
+        return response.status_code in [403, 429] and (
+                response.headers.get("X-RateLimit-Remaining") == "0" or "Retry-After" in response.headers
+                or "rate limit" in response.text.lower())
+
+    @staticmethod
+    def is_permanent_failure(response):
+        """Blocked, disabled or gone repos, retrying them will fail again."""
+        return response.status_code in [403, 410, 451] and not GitHubApi.is_rate_limited(response)
+
+    @staticmethod
+    def merge_pipeline_check_shards(shard_count, repo_list_csv_path="data/all_repos.csv",
+                                    new_csv_path="data/all_repos_has_pipeline_check_old.csv"):
+        """Check that all shards are complete and merge their pipeline checks."""
+        expected_repos = pd.read_csv(repo_list_csv_path)['full_name']
+        return Sharding.merge_shards(new_csv_path, shard_count, expected_repos, dedup_columns=['full_name'],
+                                     repo_column='full_name', use_checkpoints=False)
+
     def get_repo(self, repo_full_name):
         response = requests.get(f'{self.api}/repos/{repo_full_name}', headers=self.headers)
         repo = Repo.Repo(response.json())
@@ -173,16 +207,22 @@ class GitHubApi:
             print(f"📡 Fetching workflow runs for {owner}/{repo} on branch {branch}...")
             response = requests.get(url, headers=self.headers, params=params)
 
-            if response.status_code == 403 and "X-RateLimit-Remaining" in response.headers:
-                reset_time = int(response.headers.get("X-RateLimit-Reset", time.time()))
-                sleep_time = max(1, reset_time - int(time.time()))
+            if GitHubApi.is_rate_limited(response):
+                reset_time = int(response.headers.get("X-RateLimit-Reset", time.time() + 60))
+                sleep_time = int(response.headers.get("Retry-After", max(1, reset_time - int(time.time()))))
                 print(f"⏳ Rate limit reached! Sleeping for {sleep_time} seconds...")
                 time.sleep(sleep_time)
                 continue
 
+            if response.status_code == 404:
+                print(f" No workflow runs found for {owner}/{repo}, Status: 404")
+                break
+
             if response.status_code != 200:
+                # Don't return a partial page walk as if it were all runs of the repo
                 print(f" Failed to fetch {owner}/{repo}, Status: {response.status_code}")
-                break
+                raise requests.HTTPError(f"Failed to fetch workflow runs of {owner}/{repo}: {response.status_code}",
+                                         response=response)
 
             data = response.json()
             runs = data.get("workflow_runs", [])
@@ -220,4 +260,43 @@ class GitHubApi:
                 print("Rate limit reached! Waiting 60 seconds...")
                 time.sleep(60)
 
-        return all_runs
\ No newline at end of file
+        return all_runs
+
+    def fetch_workflow_runs_for_all_repos(self, repos_csv_path="data/all_repos_has_pipeline_check.csv",
+                                          runs_csv_path="data/workflow_runs.csv", shard=None):
+        df_repos = pd.read_csv(repos_csv_path)
+        df_repos = df_repos[df_repos['has_pipeline'] == True]
+        if shard is not None:
+            df_repos = df_repos[df_repos['full_name'].apply(lambda full_name: Sharding.in_shard(full_name, shard))]
+        runs_csv_path = Sharding.shard_path(runs_csv_path, shard)
+        # Repos without runs have no rows in the output, so progress is tracked in a separate checkpoint
+        checkpoint_path = Sharding.checkpoint_path(runs_csv_path)
+        failed_path = Sharding.failed_path(runs_csv_path)
+        # repos that failed permanently are not retried
+        processed_repos = Sharding.load_checkpoint(checkpoint_path) | set(Sharding.load_failures(failed_path))
+        print(f"Fetching workflow runs for {len(df_repos)} repositories, {len(processed_repos)} already processed.")
+
+        for index, repo in df_repos.iterrows():
+            if repo['full_name'] in processed_repos:
+                continue
+            # raises on failed requests, so only repos whose runs were all fetched are marked as done
+            try:
+                runs = self.fetch_all_workflow_runs(repo['owner'], repo['name'], repo['default_branch'])
+            except requests.HTTPError as e:
+                if e.response is None or not GitHubApi.is_permanent_failure(e.response):
+                    raise  # transient, e.g. 5xx, a rerun retries the repo
+                Sharding.mark_failed(failed_path, repo['full_name'], f"HTTP {e.response.status_code}")
+                continue
+            if runs:
+                df_runs = pd.DataFrame(runs)
+                df_runs.to_csv(runs_csv_path, mode='a', index=False, header=not os.path.exists(runs_csv_path))
+            Sharding.mark_done(checkpoint_path, repo['full_name'])
+
+    @staticmethod
+    def merge_workflow_run_shards(shard_count, repos_csv_path="data/all_repos_has_pipeline_check.csv",
+                                  runs_csv_path="data/workflow_runs.csv"):
+        """Check that all shards are complete and merge their workflow runs."""
+        df_repos = pd.read_csv(repos_csv_path)
+        expected_repos = df_repos[df_repos['has_pipeline'] == True]['full_name']
+        return Sharding.merge_shards(runs_csv_path, shard_count, expected_repos, dedup_columns=['repo', 'run_id'],
+                                     repo_column='repo')
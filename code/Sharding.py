@@ -0,0 +1,171 @@
+import hashlib
+import os
+import sqlite3
+
+import pandas as pd
+
+
+class Sharding:
+    """Deterministic split of a crawl over several nodes.
+
+    A shard is an (index, count) tuple, written as "index/count" on the command line with
+    0 <= index < count. Repos are assigned by a stable hash of their full_name, so every node
+    computes the same assignment from the same input CSV without any coordination.
+    """
+
+    @staticmethod
+    def parse_shard(value):
+        """Parse "i/N" into an (i, N) tuple."""
+        try:
+            index, count = (int(part) for part in value.split("/"))
+        except ValueError:
+            raise ValueError(f"Invalid shard '{value}', expected the form i/N, e.g. 0/4") from None
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"Invalid shard '{value}', index must be in the range 0..{count - 1}")
+        return index, count
+
+    @staticmethod
+    def shard_of(full_name, shard_count):
+        # Python's hash() is salted per process, so it can't be used to agree across nodes
+        digest = hashlib.sha1(full_name.encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") % shard_count
+
+    @staticmethod
+    def in_shard(full_name, shard):
+        if shard is None:
+            return True
+        index, count = shard
+        return Sharding.shard_of(full_name, count) == index
+
+    @staticmethod
+    def shard_path(path, shard):
+        """data/repo_commits.csv -> data/repo_commits.shard-0-of-4.csv"""
+        if shard is None:
+            return path
+        index, count = shard
+        root, extension = os.path.splitext(path)
+        return f"{root}.shard-{index}-of-{count}{extension}"
+
+    @staticmethod
+    def checkpoint_path(output_path):
+        """Path of the file listing the repos that are completely processed into output_path."""
+        return os.path.splitext(output_path)[0] + ".done"
+
+    @staticmethod
+    def load_checkpoint(checkpoint_path):
+        try:
+            with open(checkpoint_path, encoding="utf-8") as f:
+                return {line.strip() for line in f if line.strip()}
+        except FileNotFoundError:
+            return set()
+
+    @staticmethod
+    def mark_done(checkpoint_path, full_name):
+        with open(checkpoint_path, "a", encoding="utf-8") as f:
+            f.write(full_name + "\n")
+
+    @staticmethod
+    def failed_path(output_path):
+        """Path of the file listing the repos that failed permanently and are not retried."""
+        return os.path.splitext(output_path)[0] + ".failed"
+
+    @staticmethod
+    def load_failures(failed_path):
+        """Return a dict of full_name -> reason of the repos in a .failed file."""
+        try:
+            with open(failed_path, encoding="utf-8") as f:
+                return dict(line.rstrip("\n").split("\t", 1) for line in f if "\t" in line)
+        except FileNotFoundError:
+            return {}
+
+    @staticmethod
+    def mark_failed(failed_path, full_name, reason):
+        reason = " ".join(str(reason).split())
+        with open(failed_path, "a", encoding="utf-8") as f:
+            f.write(f"{full_name}\t{reason}\n")
+
+    @staticmethod
+    def merge_shards(output_path, shard_count, expected_repos, dedup_columns, repo_column="full_name",
+                     use_checkpoints=True, chunksize=100_000):
+        """Validate that every shard processed all of its repos and merge the shard outputs into output_path.
+
+        Completeness is read from the shard checkpoints, or from repo_column of the shard outputs
+        when the output itself is the checkpoint. Repos recorded in a shard's .failed file count as
+        accounted for and are reported in a merged .failed file next to output_path. Raises ValueError
+        listing the missing repos per shard instead of writing a partial result, and refuses to
+        overwrite an existing output_path. The shards are streamed in chunks and rows are
+        de-duplicated on dedup_columns, keeping the first occurrence in shard order. The keys seen so
+        far are kept in a temporary SQLite table, not in memory. Returns the number of merged rows.
+        """
+        if os.path.exists(output_path):
+            # it may hold rows of an unsharded run that are in no shard, e.g. commits already in the commit index
+            raise ValueError(f"Cannot merge into {output_path}, it already exists. Move it away first.")
+
+        shard_output_paths = [Sharding.shard_path(output_path, (index, shard_count)) for index in range(shard_count)]
+        # shards may have written their columns in a different order
+        columns = []
+        for shard_output_path in shard_output_paths:
+            if os.path.exists(shard_output_path) and os.path.getsize(shard_output_path) > 0:
+                columns += [column for column in pd.read_csv(shard_output_path, nrows=0).columns
+                            if column not in columns]
+
+        temp_path = output_path + ".tmp"
+        keys_path = output_path + ".keys.sqlite"
+        if os.path.exists(keys_path):
+            os.remove(keys_path)
+        keys = sqlite3.connect(keys_path)
+        key_columns = ", ".join(f"key_{position}" for position in range(len(dedup_columns)))
+        keys.execute(f"CREATE TABLE seen_keys ({key_columns}, PRIMARY KEY ({key_columns})) WITHOUT ROWID")
+        insert_key = f"INSERT OR IGNORE INTO seen_keys VALUES ({', '.join('?' * len(dedup_columns))})"
+
+        rows_read = 0
+        rows_written = 0
+        missing = {}
+        failures = {}
+        try:
+            with open(temp_path, "w", newline="", encoding="utf-8") as f:
+                pd.DataFrame(columns=columns).to_csv(f, index=False)
+                for index, shard_output_path in enumerate(shard_output_paths):
+                    done = set()
+                    if os.path.exists(shard_output_path) and os.path.getsize(shard_output_path) > 0:
+                        for chunk in pd.read_csv(shard_output_path, chunksize=chunksize):
+                            if not use_checkpoints:
+                                done.update(chunk[repo_column])
+                            # a key is new when inserting it changes the table
+                            keep = [keys.execute(insert_key, key).rowcount == 1
+                                    for key in chunk[dedup_columns].astype(str).itertuples(index=False, name=None)]
+                            keys.commit()
+                            chunk_merged = chunk[keep].reindex(columns=columns)
+                            chunk_merged.to_csv(f, header=False, index=False)
+                            rows_read += len(chunk)
+                            rows_written += len(chunk_merged)
+
+                    if use_checkpoints:
+                        done = Sharding.load_checkpoint(Sharding.checkpoint_path(shard_output_path))
+                    shard_failures = Sharding.load_failures(Sharding.failed_path(shard_output_path))
+                    failures.update(shard_failures)
+                    expected = {full_name for full_name in expected_repos
+                                if Sharding.shard_of(full_name, shard_count) == index}
+                    missing_repos = expected - done - set(shard_failures)
+                    if missing_repos:
+                        missing[index] = sorted(missing_repos)
+
+            if missing:
+                details = "; ".join(f"shard {index}/{shard_count} is missing {len(repos)} repos (e.g. {repos[0]})"
+                                    for index, repos in missing.items())
+                raise ValueError(f"Cannot merge {output_path}, shards are incomplete: {details}")
+            os.replace(temp_path, output_path)
+        finally:
+            keys.close()
+            for path in [temp_path, keys_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        print(f"Merged {shard_count} shards into {output_path}: {rows_written} rows, "
+              f"{rows_read - rows_written} duplicates dropped.")
+        if failures:
+            merged_failed_path = Sharding.failed_path(output_path)
+            with open(merged_failed_path, "w", encoding="utf-8") as f:
+                f.writelines(f"{full_name}\t{reason}\n" for full_name, reason in sorted(failures.items()))
+            print(f"{len(failures)} repos failed permanently and have no rows, see {merged_failed_path}.")
+        return rows_written